@@ -2,19 +2,44 @@ import sys, os
 import uuid
 import threading
 from pathlib import Path
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import boto3
 import click
+from botocore.config import Config
 
 from . import VERSION
 
-from .uploaders import upload_relative_images
+from .uploaders import upload_relative_images, S3Uploader, ETagCache, CACHE_FILENAME
 
 PRINT_LOCK = threading.Lock()
 
+# Failed jobs listed in the final report
+MAX_REPORTED_ERRORS = 100
 
-def upload_s3(file, output, location, boto3_client, **uploader_kwargs):
+# Image upload workers per file worker
+IMAGES_PER_FILE_WORKER = 4
+
+DEFAULT_PATTERN = "**/*.md"
+
+
+def _iter_md(root, exclude):
+    """Recursively yields the markdown files under `root`, equivalent to
+    `root.glob("**/*.md")` but only building a `Path` for the files kept."""
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_md(entry.path, exclude)
+            elif (
+                entry.name.endswith(".md")
+                and not (exclude and exclude in entry.name)
+                and entry.is_file()
+            ):
+                yield Path(entry.path)
+
+
+def upload_s3(file, output, location, uploader, image_executor, **uploader_kwargs):
     abs_output = output.format(filename=file.stem)
 
     absolute_path = file.with_name(abs_output)
@@ -43,15 +68,9 @@ def upload_s3(file, output, location, boto3_client, **uploader_kwargs):
         "s3",
         override=uploader_kwargs["s3_override"],
         secure_directory_fence=full_path,
-        **{
-            "s3_client": boto3_client,
-            "s3_bucket": uploader_kwargs["s3_bucket"],
-            "s3_relative_path": s3_base_key,
-            "s3_ACL": uploader_kwargs.get("s3_acl"),
-            "s3_cloudfront_domain": uploader_kwargs.get("s3_cloudfront_domain"),
-            "s3_cache_control": uploader_kwargs.get("s3_cache_control"),
-
-        },
+        uploader_instance=uploader,
+        executor=image_executor,
+        s3_relative_path=s3_base_key,
     )
     return result
 
@@ -60,6 +79,8 @@ def process_s3(files, output, location, concurrency, verbose, **uploader_kwargs)
     # Required params
     required_params = ["s3_bucket", "s3_base_key"]
     assert all([uploader_kwargs.get(param) for param in required_params])
+    if not files:
+        return
 
     optional_credential_kwargs = {
         "s3_profile_name",
@@ -75,57 +96,90 @@ def process_s3(files, output, location, concurrency, verbose, **uploader_kwargs)
     }
 
     boto3_session = boto3.Session(**session_kwargs)
-    boto3_client = boto3_session.client("s3")
+    # Enough pooled connections for every worker, so threads don't wait on
+    # the pool or re-do TLS handshakes (boto3 defaults to 10)
+    boto3_config = Config(
+        max_pool_connections=max((concurrency or 1) * 4, 32),
+        tcp_keepalive=True,
+        retries={"max_attempts": 10, "mode": "adaptive"},
+    )
+    boto3_client = boto3_session.client("s3", config=boto3_config)
+
+    # A single uploader for all the files, so the ETag cache and the
+    # uploaded images are shared by all of them
+    cache_dir = Path(os.path.commonpath([file.resolve().parent for file in files]))
+    etag_cache = ETagCache(cache_dir / CACHE_FILENAME)
+    uploader = S3Uploader(
+        s3_bucket=uploader_kwargs["s3_bucket"],
+        s3_ACL=uploader_kwargs.get("s3_acl"),
+        s3_cloudfront_domain=uploader_kwargs.get("s3_cloudfront_domain"),
+        s3_cache_control=uploader_kwargs.get("s3_cache_control"),
+        s3_client=boto3_client,
+        s3_etag_cache=etag_cache,
+    )
     # for file in files:
-    #     upload_s3(file, output, location, boto3_client, **uploader_kwargs)
+    #     upload_s3(file, output, location, uploader, image_executor, **uploader_kwargs)
 
+    # Files are processed by `ex`, while the images of all of them go through
+    # `image_executor`: total in-flight uploads are bounded by a single pool
+    # instead of growing with files x images.
     max_workers = min((concurrency or 1), len(files))
-    with ThreadPoolExecutor(max_workers=max_workers) as ex:
-        futures = {
-            ex.submit(
-                upload_s3, file, output, location, boto3_client, **uploader_kwargs
-            ): file
-            for file in files
-        }
-        success = []
-        error = []
-        for f in as_completed(futures):
-            location = futures[f]
-            with PRINT_LOCK:
-                if f.exception():
-                    print(f"FAILED: {location}")
-                    print(repr(f.exception()))
-                    error.append(f)
-                else:
-                    success.append(f)
-
-        missing_images_jobs = []
-        for future in success:
-            location = futures[future]
-            result = future.result()
-            if result is None:
-                print(f"CACHED: {location}")
-            else:
-                print(f"SUCCESS: {location}")
-                image_results, missing_images = result
-                if missing_images:
-                    missing_images_jobs.append((location, missing_images))
-
-        if missing_images_jobs:
-            print("\n\nMissing images:")
-            for location, missing_images in missing_images_jobs:
-                print(f"{location}:")
-                for missing_image in missing_images:
-                    print(f"\t{missing_image}")
-
-        if not error:
-            return
-        print("-" * 30)
-        print("Errored jobs:")
-        for future in error:
-            location = futures[future]
-            print(f"\t**{location}**: {future.exception()}")
+    image_workers = max((concurrency or 1) * IMAGES_PER_FILE_WORKER, IMAGES_PER_FILE_WORKER)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as ex, \
+                ThreadPoolExecutor(max_workers=image_workers) as image_executor:
+            futures = {
+                ex.submit(
+                    upload_s3, file, output, location, uploader, image_executor, **uploader_kwargs
+                ): file
+                for file in files
+            }
+            # Only counts and the last failures are kept, futures are dropped as
+            # soon as they're reported
+            success_n = 0
+            error_n = 0
+            errors = deque(maxlen=MAX_REPORTED_ERRORS)
+            missing_images_jobs = []
+            for f in as_completed(futures):
+                file = futures.pop(f)
+                exc = f.exception()
+                with PRINT_LOCK:
+                    if exc:
+                        print(f"FAILED: {file}")
+                        print(repr(exc))
+                        error_n += 1
+                        errors.append((file, exc))
+                        continue
+                    success_n += 1
+                    result = f.result()
+                    if result is None:
+                        print(f"CACHED: {file}")
+                    else:
+                        print(f"SUCCESS: {file}")
+                        image_results, missing_images = result
+                        if missing_images:
+                            missing_images_jobs.append((file, missing_images))
+
+            print(f"Successful: {success_n}")
+            print(f"Failed: {error_n}")
+            if missing_images_jobs:
+                print("\n\nMissing images:")
+                for file, missing_images in missing_images_jobs:
+                    print(f"{file}:")
+                    for missing_image in missing_images:
+                        print(f"\t{missing_image}")
 
+            if not errors:
+                return
+            print("-" * 30)
+            print("Errored jobs:")
+            if error_n > len(errors):
+                print(f"(only the last {len(errors)} of {error_n} are listed)")
+            for file, exc in errors:
+                print(f"\t**{file}**: {exc}")
+    finally:
+        # Keep what got uploaded, even if the run is interrupted
+        etag_cache.save()
 
 UPLOADERS = {"s3": process_s3, "imgur": None}
 
@@ -143,7 +197,7 @@ def cli():
 @click.option(
     "-p",
     "--pattern",
-    default="**/*.md",
+    default=DEFAULT_PATTERN,
     help="If `path` is a directory, this represents a Pathlib.glob pattern to scan markdown files with",
 )
 @click.option(
@@ -189,7 +243,12 @@ def cli():
 @click.option("--s3_ACL", default="private")
 @click.option("--s3_cloudfront_domain")
 @click.option("--s3_cache_control", default="public, max-age=31536000")
-@click.option("--s3_override", type=bool, default=False)
+@click.option(
+    "--s3_override",
+    type=bool,
+    default=False,
+    help=f"Upload every image again. Otherwise images unchanged since the last run (tracked in a {CACHE_FILENAME} file written next to the markdown files) are skipped",
+)
 def rel_to_abs(
     path,
     pattern,
@@ -203,8 +262,13 @@ def rel_to_abs(
 ):
     path = Path(path)
     files = [path]
-    if path.is_dir():
-        files = [file for file in path.glob(pattern) if exclude not in file.name]
+    if path.is_dir() and pattern == DEFAULT_PATTERN:
+        files = list(_iter_md(path, exclude))
+    elif path.is_dir():
+        files = [
+            file for file in path.glob(pattern)
+            if not (exclude and exclude in file.name)
+        ]
     assert uploader in {"s3", "imgur"}
     uploader_callable = UPLOADERS[uploader]
     uploader_callable(files, output, location, concurrency, verbose, **uploader_kwargs)
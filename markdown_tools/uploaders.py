@@ -1,21 +1,216 @@
+import os
 import re
+import json
+import string
+import mmap
+import secrets
+import contextlib
+import math
 import mimetypes
 import hashlib
+import functools
 from site import abs_paths
 import threading
 from pathlib import Path
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
 
 
-PATTERN_FULL = '(?:!\[(?P<alt_text>.*?)\]\((?P<filename>.*?)\))'
-PATTERN_FNAME = '(?:!\[(?:.*?)\]\((?P<filename>.*?)\))'
+# Character classes instead of lazy `.*?` keep the scan linear. `filename`
+# is the whole link target, see `_image_span` for titles and <...>.
+PATTERN_FULL = r'(?:!\[(?P<alt_text>[^\]\n]*)\]\((?P<filename>[^)\n]+)\))'
+PATTERN_FNAME = r'(?:!\[(?:[^\]\n]*)\]\((?P<filename>[^)\n]+)\))'
+
+_IMG_RE = re.compile(PATTERN_FNAME.encode())
+_TITLE_RE = re.compile(rb'\s+(?:"[^"\n]*"|\'[^\'\n]*\')\s*$')
+
+
+def _image_span(match):
+    """Span of the image path within the `filename` group of `match`, without
+    surrounding spaces, an optional "title" and the optional <...> brackets."""
+    start, end = match.span('filename')
+    target = match.group('filename')
+    title = _TITLE_RE.search(target)
+    if title:
+        target = target[:title.start()]
+    stripped = target.lstrip()
+    start += len(target) - len(stripped)
+    stripped = stripped.rstrip()
+    end = start + len(stripped)
+    if len(stripped) > 2 and stripped.startswith(b'<') and stripped.endswith(b'>'):
+        start, end = start + 1, end - 1
+    return start, end
+
+_DEFAULT_CLIENT = None
+_DEFAULT_CLIENT_LOCK = threading.Lock()
+
+MB = 1024 * 1024
+# Images below the threshold are uploaded with a single PUT. Above it,
+# parts and threads grow with the size of the image.
+S3_MULTIPART_THRESHOLD = 8 * MB
+S3_LARGE_FILE_SIZE = 128 * MB
+S3_MULTIPART_CHUNKSIZE = 8 * MB
+S3_LARGE_MULTIPART_CHUNKSIZE = 16 * MB
+S3_MAX_CONCURRENCY = 4
+S3_LARGE_MAX_CONCURRENCY = 8
+ETAG_READ_BLOCKSIZE = 1 * MB
+
+CACHE_FILENAME = '.md-tools-cache.json'
+
+# Characters that `urllib.parse.quote` leaves untouched
+_URL_SAFE = frozenset(string.ascii_letters + string.digits + "-_./~")
+
+
+def _file_digest(fp, name):
+    """Hashes the binary file `fp` with the `name` algorithm, in chunks."""
+    if hasattr(hashlib, 'file_digest'):
+        # Python 3.11+, hashes in C with the GIL released
+        return hashlib.file_digest(fp, name)
+    h = hashlib.new(name)
+    for chunk in iter(lambda: fp.read(ETAG_READ_BLOCKSIZE), b''):
+        h.update(chunk)
+    return h
+
+
+def _etag(path, part_size=None):
+    """Computes the S3 ETag of a local file without loading it in memory.
+
+    If `part_size` is given, the multipart ETag is computed instead:
+    the MD5 of the concatenated part digests, suffixed with `-<parts>`.
+    """
+    with open(path, 'rb') as fp:
+        if part_size is None:
+            return _file_digest(fp, 'md5').hexdigest()
+        if not Path(path).stat().st_size:
+            return hashlib.md5().hexdigest()
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            digests = [
+                hashlib.md5(mm[offset:offset + part_size]).digest()
+                for offset in range(0, len(mm), part_size)
+            ]
+    return hashlib.md5(b"".join(digests)).hexdigest() + f"-{len(digests)}"
+
+
+def _default_client():
+    """S3 client shared by the uploaders built without one, so credentials
+    are resolved once per process."""
+    global _DEFAULT_CLIENT
+    if _DEFAULT_CLIENT is None:
+        with _DEFAULT_CLIENT_LOCK:
+            if _DEFAULT_CLIENT is None:
+                _DEFAULT_CLIENT = boto3.client('s3')
+    return _DEFAULT_CLIENT
+
+
+def _transfer_settings(size):
+    """(multipart chunksize, max concurrency) to upload `size` bytes."""
+    if size > S3_LARGE_FILE_SIZE:
+        return S3_LARGE_MULTIPART_CHUNKSIZE, S3_LARGE_MAX_CONCURRENCY
+    return S3_MULTIPART_CHUNKSIZE, S3_MAX_CONCURRENCY
+
+
+@functools.lru_cache(maxsize=8)
+def _transfer_config(chunksize, max_concurrency):
+    return TransferConfig(
+        multipart_threshold=S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=chunksize,
+        max_concurrency=max_concurrency,
+        use_threads=True,
+    )
+
+
+def _multipart_part_size(size, parts):
+    """Guesses the part size used to upload a `size` bytes file in `parts` parts."""
+    chunksizes = [_transfer_settings(size)[0], S3_MULTIPART_CHUNKSIZE, S3_LARGE_MULTIPART_CHUNKSIZE]
+    for chunksize in chunksizes:
+        if math.ceil(size / chunksize) == parts:
+            return chunksize
+    # Uploaded with a different chunksize, most tools use whole MBs
+    return math.ceil(math.ceil(size / parts) / MB) * MB
+
+
+@functools.lru_cache(maxsize=64)
+def _content_type(suffix):
+    """Content type for a (lowercased) file suffix, cached per suffix."""
+    return mimetypes.guess_type('x' + suffix)[0]
+
+
+def _open_sibling(path, mode='wb'):
+    """Creates a new, randomly named file next to `path` and opens it with
+    `mode`. Like any new file its permissions follow the umask."""
+    path = Path(path)
+    while True:
+        tmp_path = path.with_name(f'.{path.name}.{secrets.token_hex(8)}.tmp')
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            continue
+        return os.fdopen(fd, mode), tmp_path
+
+
+def _replace(tmp_path, path):
+    """Moves `tmp_path` over `path`, keeping the mode of `path` if it exists."""
+    try:
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    except FileNotFoundError:
+        pass
+    os.replace(tmp_path, path)
+
+
+def _map_file(fp):
+    """Memory maps the (binary) file `fp` as read only. Empty files can't be
+    mapped, an empty bytes object is used in their place."""
+    if not os.fstat(fp.fileno()).st_size:
+        return contextlib.nullcontext(b"")
+    return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class ETagCache:
+    """Remembers, per uploaded object, the size and mtime of the local file
+    it was uploaded from. Persisted as JSON in `path`."""
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            with self.path.open() as fp:
+                self._entries = json.load(fp)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def get(self, bucket, key):
+        with self._lock:
+            return self._entries.get(f'{bucket}/{key}')
+
+    def set(self, bucket, key, size, mtime_ns):
+        with self._lock:
+            self._entries[f'{bucket}/{key}'] = [size, mtime_ns]
+            self._dirty = True
+
+    def save(self):
+        """Writes the cache, if anything was recorded since the last save."""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = dict(self._entries)
+            self._dirty = False
+        tmp, tmp_path = _open_sibling(self.path, 'w')
+        try:
+            with tmp:
+                json.dump(entries, tmp)
+            _replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            with self._lock:
+                self._dirty = True
+            raise
 
-S3_CLIENT_CREATION_LOCK = threading.Lock()
 
 class Uploader:
     def upload_image(self, image_path, override=False):
@@ -23,23 +218,34 @@ class Uploader:
 
 
 class S3Uploader(Uploader):
-    def __init__(self, s3_bucket, s3_relative_path, s3_ACL=None, s3_cloudfront_domain=None, s3_cache_control=None, s3_client=None):
+    def __init__(self, s3_bucket, s3_relative_path='', s3_ACL=None, s3_cloudfront_domain=None, s3_cache_control=None, s3_client=None, s3_etag_cache=None):
         self.bucket = s3_bucket
         self.relative_path = s3_relative_path.rstrip('/').lstrip('/')
         self.s3_acl = s3_ACL
         self.cloudfront_domain = s3_cloudfront_domain
         self.cache_control = s3_cache_control
+        self.etag_cache = s3_etag_cache
+
+        # sha256 of the images uploaded by this uploader: the same content
+        # found again is pointed to the existing URL.
+        self._uploaded = {}
+        self._uploaded_lock = threading.Lock()
+
+        # Remote objects listed by `prime_prefix`, key -> (ETag, size)
+        self._remote = {}
+        self._primed_prefixes = set()
+        self._priming_locks = {}
+        self._unlistable_prefixes = set()
+        self._remote_lock = threading.Lock()
 
         if self.cloudfront_domain:
             assert not self.cloudfront_domain.startswith('http://'), "Invalid cloudfront domain"
             assert not self.cloudfront_domain.startswith('https://'), "Invalid cloudfront domain"
-        if s3_client:
-            self.client = s3_client
-        else:
-            with S3_CLIENT_CREATION_LOCK:
-                self.client = boto3.client('s3')
+        self.client = s3_client or _default_client()
 
-    def upload_image(self, image_path, override=False, validate_etag=True):
+    def upload_image(self, image_path, override=False, validate_etag=True, s3_relative_path=None):
+        """Uploads `image_path` under the uploader's relative path, or under
+        `s3_relative_path` if given (so one uploader can serve many files)."""
         dns = self.cloudfront_domain or f'{self.bucket}.s3.amazonaws.com'
         p = Path(image_path)
 
@@ -49,35 +255,135 @@ class S3Uploader(Uploader):
         if self.s3_acl:
             kwargs['ACL'] = self.s3_acl
 
-        key = f'{self.relative_path}/{p.name}'
-        url = f"https://{dns}/{urllib.parse.quote(key)}"
+        relative_path = self.relative_path
+        if s3_relative_path is not None:
+            relative_path = s3_relative_path.rstrip('/').lstrip('/')
+        key = f'{relative_path}/{p.name}' if relative_path else p.name
+        if _URL_SAFE.issuperset(key):
+            url = f"https://{dns}/{key}"
+        else:
+            url = f"https://{dns}/{urllib.parse.quote(key)}"
+        st = p.stat()
         if not override:
-            try:
-                resp = self.client.head_object(Bucket=self.bucket, Key=key)
-                remote_etag = resp.get('ETag', '').strip('"')
-                if not remote_etag or not validate_etag:
+            # Local file untouched since it was last uploaded/validated
+            if self.etag_cache is not None:
+                entry = self.etag_cache.get(self.bucket, key)
+                if entry == [st.st_size, st.st_mtime_ns]:
+                    return url
+
+        remote = None if override else self._remote_object(key)
+        if remote is not None:
+            remote_etag, remote_size = remote
+            if not remote_etag or not validate_etag:
+                return url
+
+            # Different sizes mean different content, no need to hash
+            if st.st_size == remote_size:
+                part_size = None
+                if '-' in remote_etag:
+                    parts = int(remote_etag.rsplit('-', 1)[1])
+                    part_size = _multipart_part_size(st.st_size, parts)
+                if _etag(p, part_size) == remote_etag:
+                    self._cache(key, st)
                     return url
 
-                with p.open('rb') as fp:
-                    local_etag = hashlib.md5(fp.read()).hexdigest()
-                    if local_etag == remote_etag:
-                        return url
-            except ClientError as exc:
-                if exc.response['Error']['Code'] != "404":
-                    raise exc
-        content_type, _ = mimetypes.guess_type(image_path)
+        # About to upload: the same content may have been uploaded already
+        with p.open('rb') as fp:
+            digest = _file_digest(fp, 'sha256').hexdigest()
+        with self._uploaded_lock:
+            uploaded_url = self._uploaded.get(digest)
+        if uploaded_url:
+            return uploaded_url
+
+        content_type = _content_type(p.suffix.lower())
         if content_type:
             kwargs['ContentType'] = content_type
 
-        with p.open('rb') as fp:
-            self.client.put_object(
-                Body=fp.read(),
-                Bucket=self.bucket,
-                Key=key,
-                **kwargs
+        if st.st_size < S3_MULTIPART_THRESHOLD:
+            # Single PUT, the mapped file is handed to botocore without copies
+            with p.open('rb') as fp, _map_file(fp) as body:
+                self.client.put_object(
+                    Body=body,
+                    Bucket=self.bucket,
+                    Key=key,
+                    ContentLength=len(body),
+                    **kwargs
+                )
+        else:
+            # Large images are streamed from disk and uploaded in parallel parts
+            self.client.upload_file(
+                str(p),
+                self.bucket,
+                key,
+                ExtraArgs=kwargs,
+                Config=_transfer_config(*_transfer_settings(st.st_size))
             )
+        self._cache(key, st)
+        self._remember(digest, url)
         return url
 
+    def prime_prefix(self, prefix=None):
+        """Lists the objects directly under the relative path `prefix` (the
+        uploader's one by default), so `upload_image` can check the images
+        stored there without a HeadObject request per image. Each prefix is
+        listed once, primed prefixes add up across files."""
+        if prefix is None:
+            prefix = self.relative_path
+        prefix = prefix.rstrip('/').lstrip('/')
+        if not prefix:
+            # Would list the whole bucket
+            return
+        with self._remote_lock:
+            if prefix in self._primed_prefixes:
+                return
+            prefix_lock = self._priming_locks.setdefault(prefix, threading.Lock())
+        # Other workers needing the same prefix wait for this listing
+        with prefix_lock:
+            with self._remote_lock:
+                if prefix in self._primed_prefixes:
+                    return
+            remote = {}
+            paginator = self.client.get_paginator('list_objects_v2')
+            pages = paginator.paginate(Bucket=self.bucket, Prefix=f'{prefix}/', Delimiter='/')
+            for page in pages:
+                for obj in page.get('Contents', []):
+                    remote[obj['Key']] = (obj.get('ETag', '').strip('"'), obj.get('Size'))
+            with self._remote_lock:
+                self._remote.update(remote)
+                self._primed_prefixes.add(prefix)
+
+    def _remote_object(self, key):
+        """(ETag, size) of `key` in the bucket, None if it doesn't exist.
+        The first lookup under a prefix lists it, see `prime_prefix`."""
+        prefix = key.rpartition('/')[0]
+        if prefix not in self._unlistable_prefixes:
+            try:
+                self.prime_prefix(prefix)
+            except ClientError:
+                # Probably no s3:ListBucket permission, HeadObject it is
+                self._unlistable_prefixes.add(prefix)
+        with self._remote_lock:
+            if key in self._remote:
+                return self._remote[key]
+            if prefix in self._primed_prefixes:
+                # Listed already, it didn't exist
+                return None
+        try:
+            resp = self.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as exc:
+            if exc.response['Error']['Code'] != "404":
+                raise exc
+            return None
+        return resp.get('ETag', '').strip('"'), resp.get('ContentLength')
+
+    def _remember(self, digest, url):
+        with self._uploaded_lock:
+            self._uploaded.setdefault(digest, url)
+
+    def _cache(self, key, st):
+        if self.etag_cache is not None:
+            self.etag_cache.set(self.bucket, key, st.st_size, st.st_mtime_ns)
+
 
 class ImgurUploader(Uploader):
     def __init__(self, imgur_access_token):
@@ -108,7 +414,7 @@ def is_relative_to(path, other):
         return False
 
 
-def upload_relative_images(original_path, output_path, uploader, override=False, secure_directory_fence=None, **uploader_kwargs):
+def upload_relative_images(original_path, output_path, uploader, override=False, secure_directory_fence=None, per_file_concurrency=16, uploader_instance=None, executor=None, **uploader_kwargs):
     """Reads a markdown file, finds all the images and uploads them using `uploader`.
     The result is a new file under `output_path`. Provide specific parameters
     for the uploader with `uploader_kwargs`.
@@ -125,20 +431,43 @@ def upload_relative_images(original_path, output_path, uploader, override=False,
     override: bool
         Passed to the uploader, if the image should be overridden or not.
         It's responsability of the uploader to respect this flag.
+    per_file_concurrency: int
+        Max number of images of this file uploaded concurrently.
+    uploader_instance: Uploader
+        An already built uploader (of the `uploader` kind) to reuse, for
+        example across many files. Its cache and state are left to the caller.
+    executor: concurrent.futures.Executor
+        Where to run the image uploads, shared to bound the uploads of many
+        files at once. `per_file_concurrency` is ignored if given.
     **uploader_kwargs: keyword arguments
         Everything else will be passed to the Uploader at the moment of initialization.
+        For S3, an `ETagCache` stored next to `original_path` is used unless
+        `s3_etag_cache` is given.
+        If `uploader_instance` is given, they're passed to every
+        `upload_image` call instead.
     """
     is_relative = lambda url: not bool(urllib.parse.urlparse(url).netloc)
-    UploaderClass = UPLOADERS[uploader]
-    uploader = UploaderClass(**uploader_kwargs)
-
     original_path = Path(original_path)
     base_path = original_path.parent
-    pattern = re.compile(PATTERN_FNAME)
 
-    with original_path.open() as fp:
-        content = fp.read()
-        image_relative_paths = {url for url in pattern.findall(content) if is_relative(url)}
+    etag_cache = None
+    upload_kwargs = {}
+    if uploader_instance is not None:
+        uploader = uploader_instance
+        upload_kwargs = uploader_kwargs
+    else:
+        if uploader == 's3':
+            etag_cache = uploader_kwargs.setdefault(
+                's3_etag_cache', ETagCache(base_path / CACHE_FILENAME))
+        UploaderClass = UPLOADERS[uploader]
+        uploader = UploaderClass(**uploader_kwargs)
+
+    with original_path.open('rb') as fp, _map_file(fp) as content:
+        image_relative_paths = {
+            url for url in
+            (content[slice(*_image_span(m))].decode() for m in _IMG_RE.finditer(content))
+            if url and is_relative(url)
+        }
 
     abs_image_paths = [(image_relative, (base_path / urllib.parse.unquote(image_relative)).resolve()) for image_relative in image_relative_paths]
     image_mapping = {
@@ -147,21 +476,61 @@ def upload_relative_images(original_path, output_path, uploader, override=False,
     }
     # print(f"Fence: {secure_directory_fence}")
 
-    image_results = {
-        relative_path: uploader.upload_image(abs_path, override)
+    items = [
+        (relative_path, abs_path)
         for relative_path, (abs_path, exists) in image_mapping.items()
         # if is_relative_to(abs_path, secure_directory_fence) and exists
         if exists
-    }
+    ]
+    image_results = {}
+    if executor is None:
+        max_workers = max(min(len(items), per_file_concurrency or 1), 1)
+        executor_ctx = ThreadPoolExecutor(max_workers=max_workers)
+    else:
+        executor_ctx = contextlib.nullcontext(executor)
+    try:
+        with executor_ctx as ex:
+            futures = {
+                ex.submit(uploader.upload_image, abs_path, override, **upload_kwargs): relative_path
+                for relative_path, abs_path in items
+            }
+            try:
+                for f in as_completed(futures):
+                    image_results[futures[f]] = f.result()
+            except BaseException:
+                for f in futures:
+                    f.cancel()
+                raise
+    finally:
+        # Keep whatever got uploaded, even if some image failed
+        if etag_cache is not None:
+            etag_cache.save()
     missing_images = [
         relative_path for relative_path, (abs_path, exists) in image_mapping.items()
         if not exists
     ]
 
-    for relative_path, upload_path in image_results.items():
-        content = content.replace(relative_path, upload_path)
-    with open(output_path, 'w') as fp:
-        fp.write(content)
+    # Write segment by segment to a temp file and move it over `output_path`
+    # once finished, so the output is never left half written
+    output_path = Path(output_path)
+    with original_path.open('rb') as fp, _map_file(fp) as content:
+        tmp, tmp_path = _open_sibling(output_path)
+        try:
+            with tmp:
+                last = 0
+                for match in _IMG_RE.finditer(content):
+                    start, end = _image_span(match)
+                    filename = content[start:end].decode()
+                    if filename not in image_results:
+                        continue
+                    tmp.write(content[last:start])
+                    tmp.write(image_results[filename].encode())
+                    last = end
+                tmp.write(content[last:])
+            _replace(tmp_path, output_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
 
     return image_results, missing_images
 
@@ -0,0 +1,50 @@
+from markdown_tools import __main__ as main
+from markdown_tools.__main__ import _iter_md
+
+
+def test_process_s3_reports_failure_count(tmp_path, monkeypatch, capsys):
+    files = []
+    for name in ['f1.md', 'f2.md', 'f3.md']:
+        (tmp_path / name).write_text("")
+        files.append(tmp_path / name)
+
+    def upload_s3(file, *args, **kwargs):
+        raise ValueError(file.name)
+
+    monkeypatch.setattr(main, "upload_s3", upload_s3)
+    monkeypatch.setattr(main, "MAX_REPORTED_ERRORS", 2)
+    main.process_s3(
+        files, "{filename}.absolute.md", None, 1, 0,
+        s3_bucket="bucket", s3_base_key="images", s3_override=False,
+        s3_region_name="us-east-1")
+
+    out = capsys.readouterr().out
+    assert "Successful: 0" in out
+    assert "Failed: 3" in out
+    assert "(only the last 2 of 3 are listed)" in out
+
+
+def test_iter_md_matches_glob(tmp_path):
+    (tmp_path / 'a' / 'b').mkdir(parents=True)
+    for name in ['f1.md', 'a/f2.md', 'a/b/f3.md', 'a/f2.absolute.md', 'a/image.png']:
+        (tmp_path / name).write_text("")
+    (tmp_path / 'a' / 'b.md').mkdir()
+
+    expected = sorted(
+        file for file in tmp_path.glob("**/*.md")
+        if file.is_file() and 'absolute' not in file.name
+    )
+    assert sorted(_iter_md(tmp_path, 'absolute')) == expected
+
+
+def test_iter_md_blank_exclude(tmp_path):
+    (tmp_path / 'f1.md').write_text("")
+    (tmp_path / 'f1.absolute.md').write_text("")
+    assert len(list(_iter_md(tmp_path, ''))) == 2
+
+
+def test_iter_md_doesnt_follow_directory_symlinks(tmp_path):
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'a' / 'f1.md').write_text("")
+    (tmp_path / 'a' / 'loop').symlink_to(tmp_path)
+    assert list(_iter_md(tmp_path, 'absolute')) == [tmp_path / 'a' / 'f1.md']
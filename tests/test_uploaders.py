@@ -0,0 +1,382 @@
+import os
+import time
+import hashlib
+import urllib.parse
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber, ANY
+
+from markdown_tools import uploaders
+from markdown_tools.uploaders import (
+    MB, CACHE_FILENAME, S3_MULTIPART_THRESHOLD, ETagCache, S3Uploader, _etag,
+    _multipart_part_size, _transfer_config, _transfer_settings,
+    upload_relative_images)
+
+
+def multipart_etag(data, part_size):
+    digests = [
+        hashlib.md5(data[offset:offset + part_size]).digest()
+        for offset in range(0, len(data), part_size)
+    ]
+    return hashlib.md5(b"".join(digests)).hexdigest() + f"-{len(digests)}"
+
+
+def test_etag_single_part(tmp_path):
+    data = os.urandom(3 * MB + 17)
+    path = tmp_path / 'image.png'
+    path.write_bytes(data)
+    assert _etag(path) == hashlib.md5(data).hexdigest()
+
+
+def test_etag_empty_file(tmp_path):
+    path = tmp_path / 'image.png'
+    path.write_bytes(b"")
+    assert _etag(path) == hashlib.md5(b"").hexdigest()
+
+
+@pytest.mark.parametrize("size, part_size", [
+    (20 * MB + 5, 8 * MB),      # chunksize used for images up to 128 MiB
+    (40 * MB, 16 * MB),         # previous fixed chunksize
+    (23 * MB, 5 * MB),          # uploaded by another tool
+    (39 * MB, 10 * MB),
+])
+def test_multipart_etag_round_trip(tmp_path, size, part_size):
+    data = os.urandom(size)
+    path = tmp_path / 'image.png'
+    path.write_bytes(data)
+    remote_etag = multipart_etag(data, part_size)
+
+    parts = int(remote_etag.rsplit('-', 1)[1])
+    guessed = _multipart_part_size(size, parts)
+    assert guessed == part_size
+    assert _etag(path, guessed) == remote_etag
+
+
+class FakeUploader:
+    def __init__(self, **kwargs):
+        pass
+
+    def upload_image(self, image_path, override=False):
+        return f"https://cdn.example.com/{image_path.name}"
+
+
+@pytest.fixture
+def fake_uploader(monkeypatch):
+    monkeypatch.setitem(uploaders.UPLOADERS, 'fake', FakeUploader)
+    return 'fake'
+
+
+def test_upload_relative_images_rewrites_only_images(tmp_path, fake_uploader):
+    (tmp_path / 'img').mkdir()
+    (tmp_path / 'img' / 'a.png').write_bytes(b"a")
+    (tmp_path / 'img' / 'my image.png').write_bytes(b"b")
+    original = tmp_path / 'post.md'
+    original.write_text(
+        "# img/a.png\n"
+        "![img/a.png](img/a.png)\n"
+        "[link](img/a.png)\n"
+        "![](https://example.com/b.png)\n"
+        "![missing](img/missing.png)\n"
+        "![space](img/my image.png)\n"
+        "![title](img/a.png \"Title\")\n"
+        "![brackets]( <img/my image.png> )\n"
+        "![missing title](img/gone.png 'Gone')\n"
+        "![empty]( )\n"
+    )
+    output = tmp_path / 'post.absolute.md'
+
+    image_results, missing_images = upload_relative_images(original, output, fake_uploader)
+
+    assert image_results == {
+        'img/a.png': 'https://cdn.example.com/a.png',
+        'img/my image.png': 'https://cdn.example.com/my image.png',
+    }
+    assert sorted(missing_images) == ['img/gone.png', 'img/missing.png']
+    assert output.read_text() == (
+        "# img/a.png\n"
+        "![img/a.png](https://cdn.example.com/a.png)\n"
+        "[link](img/a.png)\n"
+        "![](https://example.com/b.png)\n"
+        "![missing](img/missing.png)\n"
+        "![space](https://cdn.example.com/my image.png)\n"
+        "![title](https://cdn.example.com/a.png \"Title\")\n"
+        "![brackets]( <https://cdn.example.com/my image.png> )\n"
+        "![missing title](img/gone.png 'Gone')\n"
+        "![empty]( )\n"
+    )
+
+
+def test_upload_relative_images_empty_file(tmp_path, fake_uploader):
+    original = tmp_path / 'post.md'
+    original.write_text("")
+    output = tmp_path / 'post.absolute.md'
+
+    assert upload_relative_images(original, output, fake_uploader) == ({}, [])
+    assert output.read_text() == ""
+
+
+def test_upload_relative_images_output_mode(tmp_path, fake_uploader):
+    original = tmp_path / 'post.md'
+    original.write_text("text")
+    output = tmp_path / 'post.absolute.md'
+
+    old_umask = os.umask(0o022)
+    try:
+        upload_relative_images(original, output, fake_uploader)
+    finally:
+        os.umask(old_umask)
+    assert output.stat().st_mode & 0o777 == 0o644
+
+    # An existing output keeps its mode
+    output.chmod(0o640)
+    upload_relative_images(original, output, fake_uploader)
+    assert output.stat().st_mode & 0o777 == 0o640
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['post.absolute.md', 'post.md']
+
+
+class FakeS3Client:
+    """Bucket kept in a dict, PUTs to the keys in `failing_keys` fail."""
+    def __init__(self, objects=None, failing_keys=()):
+        self.objects = dict(objects or {})
+        self.failing_keys = set(failing_keys)
+        self.calls = []
+
+    def head_object(self, Bucket, Key):
+        self.calls.append(('head_object', Key))
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        body = self.objects[Key]
+        return {'ETag': f'"{hashlib.md5(body).hexdigest()}"', 'ContentLength': len(body)}
+
+    def get_paginator(self, operation_name):
+        assert operation_name == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter):
+        self.calls.append(('list_objects_v2', Prefix))
+        contents = [
+            {'Key': key, 'ETag': f'"{hashlib.md5(body).hexdigest()}"', 'Size': len(body)}
+            for key, body in self.objects.items()
+            if key.startswith(Prefix) and Delimiter not in key[len(Prefix):]
+        ]
+        return [{'Contents': contents}]
+
+    def put_object(self, Bucket, Key, Body, ContentLength, **kwargs):
+        self.calls.append(('put_object', Key))
+        if Key in self.failing_keys:
+            raise ClientError({'Error': {'Code': '500'}}, 'PutObject')
+        self.objects[Key] = bytes(Body)
+
+
+def test_etag_cache_skips_unchanged_images(tmp_path):
+    image = tmp_path / 'image.png'
+    image.write_bytes(b"content")
+    st = image.stat()
+    cache = ETagCache(tmp_path / CACHE_FILENAME)
+    cache.set('bucket', 'post/image.png', st.st_size, st.st_mtime_ns)
+    client = FakeS3Client()
+
+    uploader = S3Uploader('bucket', 'post', s3_client=client, s3_etag_cache=cache)
+    assert uploader.upload_image(image) == 'https://bucket.s3.amazonaws.com/post/image.png'
+    assert client.calls == []
+
+    # Modified since: checked and uploaded again
+    image.write_bytes(b"new content")
+    uploader.upload_image(image)
+    assert ('put_object', 'post/image.png') in client.calls
+
+
+def test_etag_cache_saved_when_an_upload_fails(tmp_path):
+    (tmp_path / 'good.png').write_bytes(b"good")
+    (tmp_path / 'bad.png').write_bytes(b"bad")
+    original = tmp_path / 'post.md'
+    original.write_text("![](good.png)\n![](bad.png)\n")
+    client = FakeS3Client(failing_keys=['post/bad.png'])
+
+    with pytest.raises(ClientError):
+        upload_relative_images(
+            original, tmp_path / 'post.absolute.md', 's3', per_file_concurrency=2,
+            s3_client=client, s3_bucket='bucket', s3_relative_path='post')
+
+    cache = ETagCache(tmp_path / CACHE_FILENAME)
+    assert cache.get('bucket', 'post/good.png') is not None
+    assert cache.get('bucket', 'post/bad.png') is None
+
+
+def test_etag_cache_not_written_without_entries(tmp_path):
+    original = tmp_path / 'post.md'
+    original.write_text("no images\n")
+
+    upload_relative_images(
+        original, tmp_path / 'post.absolute.md', 's3',
+        s3_client=FakeS3Client(), s3_bucket='bucket', s3_relative_path='post')
+    assert not (tmp_path / CACHE_FILENAME).exists()
+
+
+def test_same_content_uploaded_once(tmp_path):
+    first = tmp_path / 'first.png'
+    first.write_bytes(b"logo")
+    copy = tmp_path / 'copy.png'
+    copy.write_bytes(b"logo")
+    client = FakeS3Client()
+
+    uploader = S3Uploader('bucket', 'post', s3_client=client)
+    first_url = uploader.upload_image(first)
+    assert uploader.upload_image(copy, s3_relative_path='other') == first_url
+    assert [call for call in client.calls if call[0] == 'put_object'] == [
+        ('put_object', 'post/first.png')]
+
+
+class QueueingExecutor(Executor):
+    """Runs the first job right away and leaves the rest queued."""
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        if not self.futures:
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as exc:
+                future.set_exception(exc)
+        self.futures.append(future)
+        return future
+
+
+class FailingUploader:
+    def upload_image(self, image_path, override=False):
+        raise RuntimeError(image_path.name)
+
+
+def test_failed_upload_cancels_queued_ones_on_shared_executor(tmp_path):
+    for name in ['a.png', 'b.png', 'c.png']:
+        (tmp_path / name).write_bytes(name.encode())
+    original = tmp_path / 'post.md'
+    original.write_text("![](a.png)\n![](b.png)\n![](c.png)\n")
+    executor = QueueingExecutor()
+
+    with pytest.raises(RuntimeError):
+        upload_relative_images(
+            original, tmp_path / 'post.absolute.md', 'fake',
+            uploader_instance=FailingUploader(), executor=executor)
+    assert len(executor.futures) == 3
+    assert all(future.cancelled() for future in executor.futures[1:])
+    assert not (tmp_path / 'post.absolute.md').exists()
+
+
+@pytest.mark.parametrize("name", ['image.png', 'my-image_2.png', 'imagen ñ.png', 'a+b%.png'])
+def test_url_matches_quoted_key(tmp_path, name):
+    image = tmp_path / name
+    image.write_bytes(b"content")
+
+    uploader = S3Uploader('bucket', 'posts/2022', s3_client=FakeS3Client())
+    url = uploader.upload_image(image)
+    assert url == f"https://bucket.s3.amazonaws.com/{urllib.parse.quote(f'posts/2022/{name}')}"
+
+
+def test_files_sharing_base_key_list_it_once(tmp_path):
+    client = FakeS3Client()
+    uploader = S3Uploader('bucket', s3_client=client)
+    for name in ['f1', 'f2']:
+        (tmp_path / f'{name}.png').write_bytes(name.encode())
+        (tmp_path / f'{name}.md').write_text(f"![]({name}.png)\n")
+        upload_relative_images(
+            tmp_path / f'{name}.md', tmp_path / f'{name}.absolute.md', 's3',
+            uploader_instance=uploader, s3_relative_path='images')
+
+    assert client.calls == [
+        ('list_objects_v2', 'images/'),
+        ('put_object', 'images/f1.png'),
+        ('put_object', 'images/f2.png'),
+    ]
+
+
+def test_concurrent_priming_lists_once(tmp_path):
+    client = FakeS3Client()
+    paginate = client.paginate
+
+    def slow_paginate(**kwargs):
+        time.sleep(0.05)
+        return paginate(**kwargs)
+
+    client.paginate = slow_paginate
+    uploader = S3Uploader('bucket', 'images', s3_client=client)
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        list(ex.map(lambda _: uploader.prime_prefix(), range(4)))
+    assert client.calls == [('list_objects_v2', 'images/')]
+
+
+@pytest.fixture
+def s3():
+    client = boto3.client(
+        's3', region_name='us-east-1',
+        aws_access_key_id='key', aws_secret_access_key='secret')
+    with Stubber(client) as stubber:
+        yield client, stubber
+        stubber.assert_no_pending_responses()
+
+
+def test_primed_prefix_skips_head_object(tmp_path, s3):
+    client, stubber = s3
+    up_to_date = tmp_path / 'up_to_date.png'
+    up_to_date.write_bytes(b"same")
+    new = tmp_path / 'new.png'
+    new.write_bytes(b"new")
+    stubber.add_response(
+        'list_objects_v2',
+        {'Contents': [{
+            'Key': 'post/up_to_date.png',
+            'ETag': f'"{hashlib.md5(b"same").hexdigest()}"',
+            'Size': 4,
+        }]},
+        {'Bucket': 'bucket', 'Prefix': 'post/', 'Delimiter': '/'})
+    stubber.add_response(
+        'put_object', {},
+        {'Bucket': 'bucket', 'Key': 'post/new.png', 'Body': ANY,
+         'ContentLength': 3, 'ContentType': 'image/png'})
+
+    uploader = S3Uploader('bucket', 'post', s3_client=client)
+    assert uploader.upload_image(up_to_date) == 'https://bucket.s3.amazonaws.com/post/up_to_date.png'
+    assert uploader.upload_image(new) == 'https://bucket.s3.amazonaws.com/post/new.png'
+
+
+def test_head_object_when_listing_is_denied(tmp_path, s3):
+    client, stubber = s3
+    image = tmp_path / 'image.png'
+    image.write_bytes(b"content")
+    stubber.add_client_error(
+        'list_objects_v2', 'AccessDenied', http_status_code=403,
+        expected_params={'Bucket': 'bucket', 'Prefix': 'post/', 'Delimiter': '/'})
+    stubber.add_response(
+        'head_object',
+        {'ETag': f'"{hashlib.md5(b"content").hexdigest()}"', 'ContentLength': 7},
+        {'Bucket': 'bucket', 'Key': 'post/image.png'})
+
+    uploader = S3Uploader('bucket', 'post', s3_client=client)
+    assert uploader.upload_image(image) == 'https://bucket.s3.amazonaws.com/post/image.png'
+
+
+@pytest.mark.parametrize("size, expected", [
+    (8 * MB, (8 * MB, 4)),
+    (128 * MB, (8 * MB, 4)),
+    (128 * MB + 1, (16 * MB, 8)),
+    (1024 * MB, (16 * MB, 8)),
+])
+def test_transfer_settings(size, expected):
+    assert _transfer_settings(size) == expected
+    config = _transfer_config(*expected)
+    assert config is _transfer_config(*expected)
+    assert (config.multipart_chunksize, config.max_concurrency) == expected
+    assert config.multipart_threshold == S3_MULTIPART_THRESHOLD
+
+
+def test_small_images_use_a_single_put(tmp_path):
+    image = tmp_path / 'image.png'
+    image.write_bytes(b"x" * (S3_MULTIPART_THRESHOLD - 1))
+    client = FakeS3Client()
+
+    S3Uploader('bucket', 'post', s3_client=client).upload_image(image, override=True)
+    assert client.calls == [('put_object', 'post/image.png')]